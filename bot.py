@@ -1,33 +1,52 @@
+import time
+import atexit
 import logging
 import telegram
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Union, Callable
+from typing import Union, Callable, Iterable, Optional
 from telegram.ext import Updater, CommandHandler, JobQueue
 
 import utils
 from database import Database, Job
-from download import JavascriptDownloader
+from download import Downloader, JavascriptDownloader
 from scrape import LinkKeywordParser
 
 
-def make_job_callback(job: Job, database_file: str) -> Callable:
+def send_message(bot: telegram.Bot, limiter: utils.RateLimiter, **kwargs) -> telegram.Message:
+    """
+    Send a message, respecting the limiter and waiting as long as Telegram asks to when flood limits are hit.
+
+    :param bot: The bot to send the message with.
+    :param limiter: Limiter shared by everything sending messages.
+    :param kwargs: The arguments for `telegram.Bot.send_message`.
+    :return: The sent message.
+    """
+    while True:
+        limiter.wait()
+        try:
+            return bot.send_message(**kwargs)
+        except telegram.error.RetryAfter as e:
+            logging.warning(f"Flood limit hit, retrying in {e.retry_after} seconds.")
+            time.sleep(e.retry_after)
+
+
+def make_job_callback(job: Job, db: Database, downloader: Downloader, executor: Executor,
+                      limiter: utils.RateLimiter) -> Callable:
     user = job.user
     url = job.url
-    keywords = job.keywords
+    # Built once, along with its keyword automaton, and reused by every run of the job.
+    parser = LinkKeywordParser(job.keywords)
 
-    def do_job(context: telegram.ext.CallbackContext):
+    def scrape(bot: telegram.Bot):
         # Download and parse the desired webpage.
-        links = LinkKeywordParser(keywords).parse(JavascriptDownloader().download(url))
+        links = parser.parse(downloader.download(url))
         if links:
-            db = Database(database_file)
-
-            # Make absolute links.
-            links = utils.to_abs_urls(url, links)
+            # Make absolute links, dropping duplicates but keeping their order on the page.
+            links = dict.fromkeys(utils.to_abs_urls(url, links)).keys()
 
             # Find which links are the new ones.
-            old_links = set(db.get_links(url))
-            # New links: remove old links.
-            new_links = list(set(links) - old_links)
+            new_links = db.new_links(url, links)
 
             # Send a notification to the user if there was anything new.
             if new_links:
@@ -35,20 +54,34 @@ def make_job_callback(job: Job, database_file: str) -> Callable:
                 try:
                     messages = utils.split_links(new_links)
                     for m in messages:
-                        context.bot.send_message(chat_id=user, text=m, disable_web_page_preview=True)
+                        send_message(bot, limiter, chat_id=user, text=m, disable_web_page_preview=True)
                 except telegram.error.Unauthorized:
                     logging.warning(f"Cannot send message to user {user}. Removing job for url {url}.")
                     db.delete_job(user, url)
 
-                # Delete old links.
-                db.reset_links(url)
                 # Keep only links that were found this time.
-                db.add_links(url, links)
+                db.replace_links(url, links)
 
                 logging.info(f"Sent {len(new_links)} links to user {user}.")
         else:
             logging.info(f"No links found on url {url} for user {user} :(")
 
+    def log_failure(future: Future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(f"Job on url {url} for user {user} failed.", exc_info=future.exception())
+
+    # The last run of the job, so that a slow run is never overlapped by the next one.
+    running: Optional[Future] = None
+
+    def do_job(context: telegram.ext.CallbackContext):
+        nonlocal running
+        if running is not None and not running.done():
+            logging.warning(f"Job on url {url} for user {user} is still running, skipping this run.")
+            return
+        # Downloads are slow: run them on the executor so the job queue can go on with other jobs.
+        running = executor.submit(scrape, context.bot)
+        running.add_done_callback(log_failure)
+
     return do_job
 
 
@@ -59,6 +92,9 @@ class Bot(object):
     LIST_USAGE = "/list"
     REMOVE_USAGE = "/remove <url>"
 
+    # Seconds between the first runs of the jobs loaded at startup.
+    _STARTUP_STAGGER = 0.01
+
     # Help message.
     HELP_MESSAGE = f"""*KeywordScrapeBot*:\n
 {ADD_USAGE}
@@ -70,14 +106,40 @@ List your running jobs.\n
 Remove a job.
     """
 
-    def __init__(self, bot_token: str, database_file: Union[str, Path], minimum_interval: int = 15):
+    def __init__(self, bot_token: str, database_file: Union[str, Path], minimum_interval: int = 15,
+                 webhook_url: str = None, listen: str = "0.0.0.0", port: int = 8443, url_path: str = None,
+                 cert: str = None, key: str = None, download_workers: int = None, browsers: int = 2):
         """
         :param bot_token: The token to run the bot on.
         :param database_file: The database file.
         :param minimum_interval: The minimum update interval in minutes. Defaults to 15.
+        :param webhook_url: Public https base url Telegram should push updates to. If None, the bot polls for updates.
+        :param listen: Address the webhook server listens on. Defaults to "0.0.0.0".
+        :param port: Port the webhook server listens on. Defaults to 8443.
+        :param url_path: Path the webhook is served on. Defaults to the bot token.
+        :param cert: Optional certificate file, for a self-signed certificate.
+        :param key: Optional private key file for `cert`.
+        :param download_workers: Maximum number of jobs scraped at once. Defaults to `browsers`.
+        :param browsers: Maximum number of browsers kept open, i.e. of pages rendered at once. Defaults to 2.
         """
-        self._database_file = database_file
+        self._webhook_url = webhook_url
+        self._listen = listen
+        self._port = port
+        self._url_path = url_path if url_path is not None else bot_token
+        self._cert = cert
+        self._key = key
+        self._db = Database(Database.initialize(database_file))
+        # In case shutdown is never called.
+        atexit.register(self._db.close)
         self._minimum_interval = minimum_interval
+        # Workers mostly wait for pages, so more of them than browsers would just wait for a browser.
+        if download_workers is None:
+            download_workers = browsers
+        self._download_pool = ThreadPoolExecutor(max_workers=download_workers)
+        # Browsers are heavy, so there are few of them, kept open across jobs and shared by the workers.
+        self._downloader = JavascriptDownloader(browsers=browsers)
+        # Telegram allows bots about 30 messages per second overall.
+        self._send_limiter = utils.RateLimiter(30)
 
         self._updater = Updater(token=bot_token, use_context=True)
         self._updater.dispatcher.add_handler(CommandHandler("start", self._add_user))
@@ -92,15 +154,37 @@ Remove a job.
 
         # Keep map {(user, url) : telegram.ext.Job} to allow canceling jobs.
         self._job_map = dict()
+        # Keep map {user : set of urls} of the scheduled jobs, for quick lookups.
+        self._user_urls = dict()
+
+        # Keep the users in the database, so that repeated /start commands do not write to it.
+        self._known_users = set(self._db.get_users())
 
         # Load all Jobs in the database.
-        for job in Database(self._database_file).get_jobs():
-            self._schedule(job)
+        self._schedule_initial(self._db.iter_jobs())
 
     def start(self):
-        self._updater.start_polling()
+        """
+        Start receiving updates: via webhook if a webhook url was given, by polling Telegram otherwise.
+        """
+        if self._webhook_url is None:
+            self._updater.start_polling()
+            return
+
+        self._updater.start_webhook(
+            listen=self._listen,
+            port=self._port,
+            url_path=self._url_path,
+            cert=self._cert,
+            key=self._key,
+            webhook_url=f"{self._webhook_url.rstrip('/')}/{self._url_path}"
+        )
+        logging.info(f"Listening for updates on {self._listen}:{self._port}.")
 
     def idle(self):
+        """
+        Block until the process receives SIGINT, SIGTERM or SIGABRT. Updates stop being received afterwards.
+        """
         self._updater.idle()
 
     def _add_user(self, update: telegram.Update, context: telegram.ext.CallbackContext):
@@ -108,8 +192,10 @@ Remove a job.
         Callback for the addition of a user.
         """
         user = update.effective_chat.id
-        # Add user to database.
-        Database(self._database_file).add_user(user)
+        # Add user to database, if new.
+        if user not in self._known_users:
+            self._db.add_user(user)
+            self._known_users.add(user)
         # Answer user.
         context.bot.send_message(chat_id=user, text=self.START_MESSAGE)
         # Log the info about the new user.
@@ -144,8 +230,8 @@ Remove a job.
             keywords = context.args[2::] if len(context.args) > 2 else list()
 
             # Update database.
-            job = Job(user, url, freq, keywords)
-            Database(self._database_file).add_job(job)
+            job = Job.from_keywords(user, url, freq, keywords)
+            self._db.add_job(job)
 
             # Schedule job.
             self._schedule(job)
@@ -164,13 +250,11 @@ Remove a job.
         Send a message containing the scheduled jobs for the user.
         """
         user = update.effective_chat.id
-        jobs = Database(self._database_file).get_jobs(user)
-        if jobs:
-            update.message.reply_markdown(
-                "\n---\n".join([f"*JOB {i + 1}*\nurl: {j.url}\nkeywords: {j.keywords}\nEvery {j.freq} hours."
-                                for i, j in enumerate(jobs)]),
-                disable_web_page_preview=True
-            )
+        # A list, not a generator: str.join would build one from it anyway.
+        text = "\n---\n".join([f"*JOB {i + 1}*\nurl: {url}\nkeywords: {keywords}\nEvery {freq} hours."
+                                for i, (url, freq, keywords) in enumerate(self._db.iter_job_view(user))])
+        if text:
+            update.message.reply_markdown(text, disable_web_page_preview=True)
         else:
             update.message.reply_text(f"No jobs scheduled.")
         logging.info(f"Sent job list to {user}.")
@@ -185,17 +269,15 @@ Remove a job.
         user = update.effective_chat.id
         try:
             url = context.args[0]
-            db = Database(self._database_file)
-            jobs = db.get_jobs(user)
 
-            # Job not in database.
-            if url not in [j.url for j in jobs]:
+            # Job not scheduled or not in database.
+            if url not in self._user_urls.get(user, ()) or not self._db.has_job(user, url):
                 update.message.reply_text(f"You have no job for url: {url}", disable_web_page_preview=True)
                 logging.info(f"User {user} asked for removal of non-existing job {url}")
                 return
 
             # Job in db, delete and unschedule job.
-            db.delete_job(user, url)
+            self._db.delete_job(user, url)
             self._unschedule(user, url)
 
             # Send back a response.
@@ -226,10 +308,29 @@ Remove a job.
 
         # Set job to run every x hours and keep track to cancel it later.
         self._job_map[(job.user, job.url)] = self._job_queue.run_repeating(
-            make_job_callback(job, self._database_file), 60 * job.freq, 1
+            make_job_callback(job, self._db, self._downloader, self._download_pool, self._send_limiter),
+            60 * job.freq, 1
         )
+        self._user_urls.setdefault(job.user, set()).add(job.url)
         logging.info(f"Started job on url {job.url} for user {job.user}.")
 
+    def _schedule_initial(self, jobs: Iterable[Job]):
+        """
+        Schedule the jobs found at startup. Assumes no job was scheduled yet, so nothing is unscheduled. First runs are
+        staggered a little, so that the jobs do not all start at the same moment.
+
+        :param jobs: The jobs to schedule.
+        """
+        count = 0
+        for job in jobs:
+            self._job_map[(job.user, job.url)] = self._job_queue.run_repeating(
+                make_job_callback(job, self._db, self._downloader, self._download_pool, self._send_limiter),
+                60 * job.freq, 1 + count * Bot._STARTUP_STAGGER
+            )
+            self._user_urls.setdefault(job.user, set()).add(job.url)
+            count += 1
+        logging.info(f"Started {count} jobs from the database.")
+
     def _unschedule(self, user: int, url: str):
         """
         Remove the corresponding job from the queue.
@@ -237,12 +338,24 @@ Remove a job.
         :param user: The user of the job.
         :param url: The url of the job.
         """
+        urls = self._user_urls.get(user)
+        if urls is not None:
+            urls.discard(url)
+            if not urls:
+                del self._user_urls[user]
+
         old_job = self._job_map.pop((user, url), 0)
         if old_job != 0:
             old_job.schedule_removal()
             logging.info(f"Removed Telegram job on url {url} for user {user}.")
 
-    def __del__(self):
-        # Stop za bot.
+    def shutdown(self):
+        """
+        Stop za bot: stop receiving updates and running jobs, then release browsers and database connections.
+        """
         self._job_queue.stop()
         self._updater.stop()
+        # Drop queued scrapes and let running ones end, so none is left waiting on a closed browser or connection.
+        self._download_pool.shutdown(wait=True, cancel_futures=True)
+        self._downloader.close()
+        self._db.close()
@@ -1,38 +1,188 @@
-import logging
+import queue
 import sqlite3
+import threading
 
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import List, Optional
+from functools import cached_property
+from typing import Iterable, Iterator, List, Optional, Tuple
 
 from scrape import Link
 
 
+# Statements, written once so that every call hands sqlite the very same string.
+_SQL_ADD_USER = "INSERT OR IGNORE INTO users(id) VALUES (?);"
+_SQL_GET_USERS = "SELECT * FROM users;"
+_SQL_ADD_JOB = "INSERT OR REPLACE INTO jobs(user, url, freq, keywords) VALUES (?, ?, ?, ?);"
+_SQL_GET_JOBS = "SELECT * FROM jobs;"
+_SQL_GET_USER_JOBS = "SELECT * FROM jobs WHERE jobs.user = ?;"
+_SQL_GET_JOB_VIEW = "SELECT url, freq, keywords FROM jobs WHERE user = ?;"
+_SQL_HAS_JOB = "SELECT 1 FROM jobs WHERE user = ? AND url = ? LIMIT 1;"
+_SQL_DELETE_JOB = "DELETE FROM jobs WHERE user = ? AND url = ?;"
+_SQL_ADD_LINK = "INSERT OR REPLACE INTO links(url, href, body) VALUES (?, ?, ?);"
+_SQL_GET_LINKS = "SELECT * FROM links;"
+_SQL_GET_URL_LINKS = "SELECT * FROM links WHERE links.url = ?;"
+_SQL_RESET_LINKS = "DELETE FROM links WHERE url = ?;"
+_SQL_CREATE_CANDIDATES = "CREATE TEMP TABLE IF NOT EXISTS candidates (href text NOT NULL, body text NOT NULL);"
+_SQL_ADD_CANDIDATE = "INSERT INTO temp.candidates(href, body) VALUES (?, ?);"
+_SQL_NEW_CANDIDATES = """SELECT DISTINCT c.href, c.body FROM temp.candidates c
+    LEFT JOIN links l ON l.url = ? AND l.href = c.href AND l.body = c.body
+    WHERE l.url IS NULL;"""
+
+
 @dataclass(repr=True)
 class Job(object):
     """
-    Class representing an object. Keywords will be stripped of whitespaces and set to lower case.
+    Class representing an object. Keywords are kept as they are stored: a single string of lower case words separated
+    by spaces, only split into a list when `keywords` is first read.
     If a keyword is, for instance "a b" it will be serialized as such, and later read as two keywords "a" and "b".
     """
     user: int
     url: str
     freq: int
-    keywords: List[str] = None
+    # The keywords, in a single string separated by spaces, or None if there are no keywords.
+    kw_string: Optional[str] = None
+
+    @classmethod
+    def from_keywords(cls, user: int, url: str, freq: int, keywords: List[str] = None) -> 'Job':
+        """
+        :param user: The user that owns the job.
+        :param url: The url of the job.
+        :param freq: The period of the job.
+        :param keywords: The keywords. Will be stripped of whitespaces and set to lower case.
+        :return: The corresponding Job.
+        """
+        keywords = [k.strip().lower() for k in keywords] if keywords else None
+        return cls(user, url, freq, ' '.join(keywords) if keywords else None)
+
+    @classmethod
+    def from_row(cls, row: Tuple[int, str, int, Optional[str]]) -> 'Job':
+        """
+        :param row: A (user, url, freq, keywords) row from the jobs table.
+        :return: The corresponding Job.
+        """
+        return cls(row[0], row[1], row[2], row[3])
+
+    @cached_property
+    def keywords(self) -> Optional[List[str]]:
+        """
+        :return: The list of keywords, or None if there are no keywords.
+        """
+        return self.kw_string.split() if self.kw_string else None
+
+
+# Queued in place of a reader once the pool is closed.
+_CLOSED = object()
+
+
+class ConnectionPool(object):
+    """
+    Process-wide set of connections to a single database file, opened once and shared between threads.
+    Writes go through one dedicated connection, serialized by a lock, while reads are spread over a small queue of
+    connections.
+    """
 
-    def __post_init__(self):
-        # Ensure the keywords are properly formatted.
-        if self.keywords is None:
+    def __init__(self, filename: str, readers: int = 4):
+        """
+        :param filename: Name of the database file.
+        :param readers: Number of connections used for reading.
+        """
+        self._filename = filename
+        self._writer = self._connect()
+        # WAL lets readers go on while the writer commits. The journal mode is stored in the file, so set it once.
+        self._writer.execute("PRAGMA journal_mode = WAL;")
+        self._writer.execute("PRAGMA wal_autocheckpoint = 1000;")
+        self._writer_lock = threading.Lock()
+        # Guards _closed, so that readers given back after closing are closed instead of queued.
+        self._lock = threading.Lock()
+        self._closed = False
+        self._readers = queue.Queue()
+        for _ in range(readers):
+            self._readers.put(self._connect())
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        :return: A new connection, usable from any thread, in autocommit mode.
+        """
+        conn = sqlite3.connect(
+            self._filename, check_same_thread=False, isolation_level=None, cached_statements=256
+        )
+        # Ensure foreign keys are enabled.
+        conn.execute("PRAGMA foreign_keys = ON;")
+        # With WAL, NORMAL only syncs at checkpoints instead of every commit.
+        conn.execute("PRAGMA synchronous = NORMAL;")
+        conn.execute("PRAGMA temp_store = MEMORY;")
+        conn.execute("PRAGMA mmap_size = 268435456;")
+        conn.execute("PRAGMA cache_size = -20000;")
+        return conn
+
+    @contextmanager
+    def acquire(self, write: bool = False) -> Iterator[sqlite3.Connection]:
+        """
+        Borrow a connection from the pool, giving it back when the context exits.
+
+        :param write: If True, get the writer connection, with everything run inside the context in one transaction.
+        :return: The connection.
+        """
+        if not write:
+            conn = self._readers.get()
+            if conn is _CLOSED:
+                # Pass the marker on to whoever else is waiting.
+                self._readers.put(conn)
+                raise sqlite3.ProgrammingError("Cannot operate on a closed connection pool.")
+            try:
+                yield conn
+            finally:
+                self._give_back(conn)
             return
-        self.keywords = list(map(lambda x: x.strip().lower(), self.keywords))
 
-    @property
-    def kw_string(self) -> Optional[str]:
+        with self._writer_lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Cannot operate on a closed connection pool.")
+            self._writer.execute("BEGIN;")
+            try:
+                yield self._writer
+            except BaseException:
+                self._writer.execute("ROLLBACK;")
+                raise
+            self._writer.execute("COMMIT;")
+
+    def _give_back(self, conn: sqlite3.Connection):
+        """
+        :param conn: A borrowed reader. Queued again, or closed if the pool was closed in the meantime.
+        """
+        with self._lock:
+            if not self._closed:
+                self._readers.put(conn)
+                return
+        # No optimize: the WAL was already emptied by close, do not write to it again.
+        conn.close()
+
+    def close(self):
         """
-        :return: The keywords, in a single string separated by spaces, or None if there are no keywords.
+        Close the idle readers and the writer, readers still borrowed are closed when given back. Any later or pending
+        attempt to acquire a connection raises `sqlite3.ProgrammingError`. Does nothing if already closed.
         """
-        if self.keywords:
-            return ' '.join(self.keywords)
-        else:
-            return None
+        with self._writer_lock:
+            with self._lock:
+                if self._closed:
+                    return
+                self._closed = True
+            # Statistics for the query planner are refreshed where the queries run on each connection would benefit from
+            # them. This may write, so it happens before the checkpoint.
+            while True:
+                try:
+                    conn = self._readers.get_nowait()
+                except queue.Empty:
+                    break
+                conn.execute("PRAGMA optimize;")
+                conn.close()
+            # Wake up whoever is waiting for a reader.
+            self._readers.put(_CLOSED)
+            self._writer.execute("PRAGMA optimize;")
+            # Copy everything in the WAL back into the database and empty it, even if some reader is still borrowed.
+            self._writer.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+            self._writer.close()
 
 
 class Database(object):
@@ -40,6 +190,7 @@ class Database(object):
     Interface to manage an sqlite database to contain users and such.
     Handle database files with care, do not modify them via other classes. This class expects the provided files to be
     either empty or have the schema that is created if the file is empty.
+    Instances are cheap: they only borrow connections from a `ConnectionPool` created via `Database.initialize`.
 
     Schema:
     ```sql
@@ -52,29 +203,47 @@ class Database(object):
         -- string of words separated by a space.
         keywords text,
         FOREIGN KEY (user) REFERENCES users(id),
+        -- also serves lookups by user alone.
         PRIMARY KEY (user, url)
     );
     CREATE TABLE links (
         url text NOT NULL,
         href text NOT NULL,
         body text NOT NULL,
+        -- also serves lookups by url alone.
         PRIMARY KEY (url, href, body)
     );
     ```
     """
 
-    _TABLE_EXISTS = "Table \"{}\" already present, skipping it."
+    def __init__(self, pool: ConnectionPool):
+        """
+        :param pool: The pool to take connections from.
+        """
+        self._pool = pool
 
-    def __init__(self, filename: str):
+    def close(self):
         """
-        :param filename: Name of the database file that will be created in the current working directory.
+        Close the underlying pool. Any other `Database` object sharing it becomes unusable too.
         """
-        self._filename = filename
-        self._conn = sqlite3.connect(filename)
+        self._pool.close()
+
+    def __enter__(self) -> 'Database':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
-        with self._conn as c:
-            # Ensure foreign keys are enabled.
-            c.execute("PRAGMA foreign_keys = ON;")
+    @classmethod
+    def initialize(cls, filename: str) -> ConnectionPool:
+        """
+        Prepare the database file, if needed, and open the connections to it. Meant to be called once per process.
+
+        :param filename: Name of the database file that will be created in the current working directory.
+        :return: The pool to build `Database` objects with.
+        """
+        cls.prepare_db(filename)
+        return ConnectionPool(filename)
 
     def add_user(self, new_user: int):
         """
@@ -82,14 +251,15 @@ class Database(object):
 
         :param new_user: Id for the new user to add.
         """
-        with self._conn as c:
-            c.execute("INSERT OR IGNORE INTO users(id) VALUES (?);", (new_user,))
+        with self._pool.acquire(write=True) as c:
+            c.execute(_SQL_ADD_USER, (new_user,))
 
     def get_users(self) -> List[int]:
         """
         :return: The list of ids for the users.
         """
-        return [r[0] for r in self._conn.execute("SELECT * FROM users;")]
+        with self._pool.acquire() as c:
+            return [r[0] for r in c.execute(_SQL_GET_USERS)]
 
     def add_job(self, job: Job):
         """
@@ -97,23 +267,50 @@ class Database(object):
 
         :param job: The job to add.
         """
-        with self._conn as c:
-            c.execute(
-                "INSERT OR REPLACE INTO jobs(user, url, freq, keywords) VALUES (?, ?, ?, ?);",
-                (job.user, job.url, job.freq, job.kw_string)
-            )
+        with self._pool.acquire(write=True) as c:
+            c.execute(_SQL_ADD_JOB, (job.user, job.url, job.freq, job.kw_string))
 
     def get_jobs(self, user: int = None) -> List[Job]:
         """
         :param user : The user. If None, all Jobs are returned.
         :return: A list of the jobs in the database.
         """
-        if user is None:
-            return [Job(r[0], r[1], r[2], r[3].split() if r[3] else None)
-                    for r in self._conn.execute("SELECT * FROM jobs;")]
-        else:
-            return [Job(r[0], r[1], r[2], r[3].split() if r[3] else None)
-                    for r in self._conn.execute("SELECT * FROM jobs WHERE jobs.user = ?;", (user,))]
+        return list(self.iter_jobs(user))
+
+    def iter_jobs(self, user: int = None) -> Iterator[Job]:
+        """
+        Like `get_jobs`, but jobs are built while rows are read. A connection is held until the
+        iterator is exhausted or discarded.
+
+        :param user : The user. If None, all Jobs are returned.
+        :return: An iterator over the jobs in the database.
+        """
+        with self._pool.acquire() as c:
+            if user is None:
+                cursor = c.execute(_SQL_GET_JOBS)
+            else:
+                cursor = c.execute(_SQL_GET_USER_JOBS, (user,))
+            for r in cursor:
+                yield Job.from_row(r)
+
+    def iter_job_view(self, user: int) -> Iterator[Tuple[str, int, Optional[str]]]:
+        """
+        Lightweight alternative to `get_jobs` for display purposes: no `Job` objects are built.
+
+        :param user: The user.
+        :return: An iterator over the (url, freq, keywords) rows of the user's jobs. Keywords are a single string.
+        """
+        with self._pool.acquire() as c:
+            yield from c.execute(_SQL_GET_JOB_VIEW, (user,))
+
+    def has_job(self, user: int, url: str) -> bool:
+        """
+        :param user: The user that owns the job.
+        :param url: The url of the job.
+        :return: True if the user has a job for the url, False otherwise.
+        """
+        with self._pool.acquire() as c:
+            return c.execute(_SQL_HAS_JOB, (user, url)).fetchone() is not None
 
     def delete_job(self, user: int, url: str):
         """
@@ -122,8 +319,8 @@ class Database(object):
         :param user: The user that owns the job.
         :param url: The url of the job.
         """
-        with self._conn as c:
-            c.execute("DELETE FROM jobs WHERE user = ? AND url = ?;", (user, url))
+        with self._pool.acquire(write=True) as c:
+            c.execute(_SQL_DELETE_JOB, (user, url))
 
     def add_link(self, url: str, link: Link):
         """
@@ -132,33 +329,68 @@ class Database(object):
         :param url: The url of the page hosting the link.
         :param link: The link object.
         """
-        with self._conn as c:
-            c.execute("INSERT OR REPLACE INTO links(url, href, body) VALUES (?, ?, ?);", (url, link.href, link.text))
+        with self._pool.acquire(write=True) as c:
+            c.execute(_SQL_ADD_LINK, (url, link.href, link.text))
 
-    def add_links(self, url: str, links: List[Link]):
+    def add_links(self, url: str, links: Iterable[Link]):
         """
         Add a set of links to the database.
 
         :param url: The url of the page hosting the links.
-        :param links: The list of links to add.
+        :param links: The links to add.
+        """
+        with self._pool.acquire(write=True) as c:
+            c.executemany(_SQL_ADD_LINK, ((url, link.href, link.text) for link in links))
+
+    def replace_links(self, url: str, links: Iterable[Link]):
+        """
+        Replace the links for a given page with new ones, in a single transaction.
+
+        :param url: The url of the page hosting the links.
+        :param links: The links that will be kept.
+        """
+        with self._pool.acquire(write=True) as c:
+            c.execute(_SQL_RESET_LINKS, (url,))
+            c.executemany(_SQL_ADD_LINK, ((url, link.href, link.text) for link in links))
+
+    def new_links(self, url: str, candidates: Iterable[Link]) -> List[Link]:
+        """
+        :param url: The url of the page hosting the links.
+        :param candidates: The links found on the page.
+        :return: The candidates that are not stored for the page, without duplicates.
         """
-        with self._conn as c:
-            c.executemany(
-                "INSERT OR REPLACE INTO links(url, href, body) VALUES (?, ?, ?);",
-                [(url, link.href, link.text) for link in links]
-            )
+        with self._pool.acquire() as c:
+            c.execute(_SQL_CREATE_CANDIDATES)
+            c.execute("BEGIN;")
+            try:
+                c.executemany(_SQL_ADD_CANDIDATE, ((link.href, link.text) for link in candidates))
+                return [Link(r[0], r[1]) for r in c.execute(_SQL_NEW_CANDIDATES, (url,))]
+            finally:
+                # Only the temporary table was written, rolling back just empties it.
+                c.execute("ROLLBACK;")
 
     def get_links(self, url: str = None) -> List[Link]:
         """
         :param url: Optional host web page. If None all links will be retrieved.
         :return: The links hosted in `url` or all of them if `url` is None.
         """
-        if url is None:
-            return [Link(r[1], r[2]) for r in self._conn.execute("SELECT * FROM links;")]
-        else:
-            return [Link(r[1], r[2]) for r in self._conn.execute(
-                "SELECT * FROM links WHERE links.url = ?;", (url,)
-            )]
+        return list(self.iter_links(url))
+
+    def iter_links(self, url: str = None) -> Iterator[Link]:
+        """
+        Like `get_links`, but links are built while rows are read. A connection is held until the
+        iterator is exhausted or discarded.
+
+        :param url: Optional host web page. If None all links will be retrieved.
+        :return: An iterator over the links hosted in `url` or all of them if `url` is None.
+        """
+        with self._pool.acquire() as c:
+            if url is None:
+                cursor = c.execute(_SQL_GET_LINKS)
+            else:
+                cursor = c.execute(_SQL_GET_URL_LINKS, (url,))
+            for r in cursor:
+                yield Link(r[1], r[2])
 
     def reset_links(self, url: str):
         """
@@ -166,12 +398,8 @@ class Database(object):
 
         :param url: The page for which to clean the links.
         """
-        with self._conn as c:
-            c.execute("DELETE FROM links WHERE url = ?;", (url,))
-
-    def __del__(self):
-        # Close the connection when object is deleted.
-        self._conn.close()
+        with self._pool.acquire(write=True) as c:
+            c.execute(_SQL_RESET_LINKS, (url,))
 
     @staticmethod
     def prepare_db(filename: str):
@@ -181,33 +409,24 @@ class Database(object):
 
         :param filename: The filename for the db.
         """
-        with sqlite3.connect(filename) as c:
-            # Create user table.
-            try:
-                c.execute("CREATE TABLE users (id integer PRIMARY KEY);")
-            except sqlite3.OperationalError:
-                logging.warning(Database._TABLE_EXISTS.format("users"))
-
-            # Create job table.
-            try:
-                c.execute("""CREATE TABLE jobs (
+        conn = sqlite3.connect(filename)
+        try:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS users (id integer PRIMARY KEY);
+                CREATE TABLE IF NOT EXISTS jobs (
                     user integer NOT NULL,
                     url text NOT NULL,
                     freq integer NOT NULL,
                     keywords text,
                     FOREIGN KEY (user) REFERENCES users(id),
                     PRIMARY KEY (user, url)
-                );""")
-            except sqlite3.OperationalError:
-                logging.warning(Database._TABLE_EXISTS.format("jobs"))
-
-            # Create link table.
-            try:
-                c.execute("""CREATE TABLE links (
+                );
+                CREATE TABLE IF NOT EXISTS links (
                     url text NOT NULL,
                     href text NOT NULL,
                     body text NOT NULL,
                     PRIMARY KEY (url, href, body)
-                );""")
-            except sqlite3.OperationalError:
-                logging.warning(Database._TABLE_EXISTS.format("links"))
+                );
+            """)
+        finally:
+            conn.close()
@@ -1,6 +1,16 @@
+import queue
+import threading
+import contextlib
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+
 import utils
 
 
+# Queued in place of a browser once the downloader is closed.
+_CLOSED = object()
+
+
 class Downloader(object):
     """
     Base class for a downloader.
@@ -13,19 +23,99 @@ class Downloader(object):
         """
         raise NotImplementedError()
 
+    def download_many(self, targets: List[str]) -> List[str]:
+        """
+        :param targets: The targets. e.g. the web page URLs.
+        :return: The contents, in the same order as the targets.
+        """
+        return [self.download(t) for t in targets]
+
 
 class JavascriptDownloader(Downloader):
     """
     Downloader that also runs the Javascript in the web page before downloading.
+    Browsers are started when first needed and kept open for later downloads. Safe to use from multiple threads, each
+    download takes a browser for itself.
     """
 
+    def __init__(self, browsers: int = 1):
+        """
+        :param browsers: The maximum number of browsers to keep open, i.e. of simultaneous downloads.
+        """
+        self._size = browsers
+        # Idle browsers, None stands for one that was not started yet. Last in first out, so that running browsers
+        # are reused before new ones are started.
+        self._browsers = queue.LifoQueue()
+        for _ in range(browsers):
+            self._browsers.put(None)
+        # Guards _closed, so that browsers given back after closing are quit instead of queued.
+        self._lock = threading.Lock()
+        self._closed = False
+
     def download(self, target: str) -> str:
         """
         :param target: The target. e.g. the web page URL.
         :return: The content.
         """
-        browser = utils.get_firefox()
-        browser.get(target)
-        content = browser.page_source
-        browser.close()
+        browser = self._browsers.get()
+        if browser is _CLOSED:
+            # Pass the marker on to whoever else is waiting.
+            self._browsers.put(browser)
+            raise RuntimeError("Cannot download with a closed downloader.")
+        try:
+            if browser is None:
+                browser = utils.get_firefox()
+            browser.get(target)
+            content = browser.page_source
+        except BaseException:
+            # The browser may be in a bad state, start a new one next time.
+            self._give_back(None)
+            if browser is not None:
+                with contextlib.suppress(Exception):
+                    browser.quit()
+            raise
+        self._give_back(browser)
         return content
+
+    def download_many(self, targets: List[str]) -> List[str]:
+        """
+        Download the targets in parallel, using as many browsers as possible.
+
+        :param targets: The targets. e.g. the web page URLs.
+        :return: The contents, in the same order as the targets.
+        """
+        if not targets:
+            return list()
+        with ThreadPoolExecutor(max_workers=min(self._size, len(targets))) as executor:
+            return list(executor.map(self.download, targets))
+
+    def _give_back(self, browser):
+        """
+        :param browser: A browser taken for a download, or None. Queued again, or quit if the downloader was closed in
+        the meantime.
+        """
+        with self._lock:
+            if not self._closed:
+                self._browsers.put(browser)
+                return
+        if browser is not None:
+            browser.quit()
+
+    def close(self):
+        """
+        Quit the idle browsers, browsers busy downloading are quit when their download ends. Any later or pending
+        download raises `RuntimeError`. Does nothing if already closed.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        while True:
+            try:
+                browser = self._browsers.get_nowait()
+            except queue.Empty:
+                break
+            if browser is not None:
+                browser.quit()
+        # Wake up whoever is waiting for a browser.
+        self._browsers.put(_CLOSED)
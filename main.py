@@ -1,7 +1,6 @@
 import os
 import logging
 from bot import Bot
-from database import Database
 
 import utils
 
@@ -26,10 +25,12 @@ config = utils.get_config("config.json")
 
 
 def main():
-    Database.prepare_db(config["database_file"])
     bot = Bot(**config)
-    bot.start()
-    bot.idle()
+    try:
+        bot.start()
+        bot.idle()
+    finally:
+        bot.shutdown()
 
 
 if __name__ == '__main__':
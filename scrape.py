@@ -1,6 +1,11 @@
-from typing import List
-from dataclasses import dataclass
-from bs4 import BeautifulSoup
+from typing import List, NamedTuple, Sequence
+from selectolax.lexbor import LexborHTMLParser
+
+try:
+    # Look for all keywords in a single pass over the text, if available.
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 
 class Parser(object):
@@ -13,8 +18,7 @@ class Parser(object):
         raise NotImplementedError()
 
 
-@dataclass(repr=True, eq=True, frozen=True)
-class Link(object):
+class Link(NamedTuple):
     href: str
     text: str
 
@@ -25,37 +29,46 @@ class LinkKeywordParser(Parser):
     their text. If no keywords are given it just returns all the links.
     """
 
-    def __init__(self, keywords: List[str] = None):
+    def __init__(self, keywords: Sequence[str] = None):
         """
         :param keywords: The keywords to look for in the link texts. Will be put in lower case.
         """
         self.keywords = keywords
         if self.keywords is not None:
-            self.keywords = tuple(map(lambda k: k.lower(), self.keywords))
+            self.keywords = tuple(map(str.lower, self.keywords))
+
+        # Automaton matching any of the keywords, None if unavailable.
+        self._automaton = None
+        if self.keywords and ahocorasick is not None:
+            self._automaton = ahocorasick.Automaton()
+            for k in self.keywords:
+                self._automaton.add_word(k, k)
+            self._automaton.make_automaton()
 
     def parse(self, content: str) -> List[Link]:
         """
         :param content: Content of the web page to parse.
         :return: A list of links. Excludes any link with href equal to '#'.
         """
-        # Get the links from the page.
-        soup = BeautifulSoup(content, "html.parser")
-        links = [Link(t.get("href"), t.get_text().strip()) for t in soup("a")]
-        links = filter(lambda link: link.href != '#', links)
-
-        # If no keywords, all links automatically match.
-        if self.keywords is None:
-            return list(links)
-
-        # Otherwise, return only the ones containing the keywords.
-        return list(filter(self._matches, links))
+        # Extract and filter the links in a single pass over the page.
+        links = list()
+        for n in LexborHTMLParser(content).css("a"):
+            href = n.attributes.get("href")
+            if href == '#':
+                continue
+            text = n.text().strip()
+            # If no keywords, all links automatically match.
+            if self.keywords is None or self._matches(text.lower()):
+                links.append(Link(href, text))
+        return links
 
-    def _matches(self, link: Link) -> bool:
+    def _matches(self, text: str) -> bool:
         """
-        :param link: A link object.
-        :return: True if the link's lower case text contains at least one of the given keywords, False otherwise.
+        :param text: A link's text, in lower case.
+        :return: True if the text contains at least one of the given keywords, False otherwise.
         """
-        text = link.text.lower()
+        if self._automaton is not None:
+            return next(self._automaton.iter(text), None) is not None
         for k in self.keywords:
             if k in text:
                 return True
@@ -1,8 +1,10 @@
 import json
 import re
+import time
+import threading
 import urllib.parse
 import selenium.webdriver.firefox.webdriver
-from typing import Union, Dict, List
+from typing import Union, Dict, Iterable, List
 from pathlib import Path
 from selenium import webdriver
 from selenium.webdriver.firefox.options import Options
@@ -10,6 +12,15 @@ from telegram.constants import MAX_MESSAGE_LENGTH
 
 from scrape import Link
 
+try:
+    # Linear time matching, without backtracking, if available.
+    import re2 as _re
+    # End of the text, spelled per engine: re's $ also matches before a trailing newline, unlike re2's.
+    _END = r'\z'
+except ImportError:
+    _re = re
+    _END = r'\Z'
+
 
 def get_config(file: Union[str, Path]) -> Dict:
     """
@@ -29,6 +40,19 @@ def get_config(file: Union[str, Path]) -> Dict:
     return data
 
 
+# Compiled once, used by is_valid_url. Flags are inline, as re2 does not take re's flags.
+_URL_RE = _re.compile(
+    r'(?i)'  # ignore case
+    r'^(?:http|ftp)s?://'  # http:// or https://
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'  # domain...
+    r'localhost|'  # localhost...
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
+    r'(?::\d+)?'  # optional port
+    r'(?:/?|[/?]\S+)' + _END
+)
+_url_match = _URL_RE.match
+
+
 def is_valid_url(url: str) -> bool:
     """
     Check if a given url is valid.
@@ -37,16 +61,13 @@ def is_valid_url(url: str) -> bool:
     :param url: The url to check.
     :return: True if the url is valid, False otherwise.
     """
-    regex = re.compile(
-        r'^(?:http|ftp)s?://'  # http:// or https://
-        r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'  # domain...
-        r'localhost|'  # localhost...
-        r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
-        r'(?::\d+)?'  # optional port
-        r'(?:/?|[/?]\S+)$',
-        re.IGNORECASE
-    )
-    return re.match(regex, url) is not None
+    return _url_match(url) is not None
+
+
+# Absolute http(s) urls that urljoin would return unchanged: with a host, and without empty query, fragment or
+# parameters, tabs, newlines or brackets, all of which it normalizes or rejects.
+_PLAIN_ABS_URL_RE = re.compile(r'https?://(?!.*\?#)[^/?#;\[\]\t\r\n][^;\[\]\t\r\n]*(?<![?#])')
+_is_plain_abs_url = _PLAIN_ABS_URL_RE.fullmatch
 
 
 def to_abs_urls(url, links: List[Link]) -> List[Link]:
@@ -55,7 +76,9 @@ def to_abs_urls(url, links: List[Link]) -> List[Link]:
     :param links: The links to turn into absolute paths.
     :return: A list of absolute links.
     """
-    return [Link(urllib.parse.urljoin(url, link.href), link.text) for link in links]
+    # Most links on a page are already absolute, and joining them would just parse them for nothing.
+    return [link if link.href is not None and _is_plain_abs_url(link.href)
+            else Link(urllib.parse.urljoin(url, link.href), link.text) for link in links]
 
 
 def get_firefox() -> selenium.webdriver.firefox.webdriver.WebDriver:
@@ -64,26 +87,55 @@ def get_firefox() -> selenium.webdriver.firefox.webdriver.WebDriver:
     return webdriver.Firefox(options=options)
 
 
-def split_links(links: List[Link]) -> List[str]:
+def split_links(links: Iterable[Link]) -> List[str]:
     """
-    :param links: The links to build messages for. List must not be empty.
+    :param links: The links to build messages for. Must not be empty.
     :return: The message, split in multiple parts to avoid breaching max Telegram message size.
     """
     sep = "\n---\n"
     result = list()
-    msg = f"{links[0].text}\n{links[0].href}"
+    # Entries of the current message, and the length they will have once joined.
+    entries = list()
+    length = -len(sep)
 
     # For each link.
-    for link in links[1::]:
-        entry = sep + f"{link.text}\n{link.href}"
+    for link in links:
+        entry = f"{link.text}\n{link.href}"
         # If too long, break current message.
-        if len(msg) + len(entry) > MAX_MESSAGE_LENGTH:
-            result.append(msg)
-            msg = f"{link.text}\n{link.href}"
-        # Otherwise, append to current message.
-        else:
-            msg += entry
+        if entries and length + len(sep) + len(entry) > MAX_MESSAGE_LENGTH:
+            result.append(sep.join(entries))
+            entries = list()
+            length = -len(sep)
+        # Append to current message.
+        entries.append(entry)
+        length += len(sep) + len(entry)
     # Last message.
-    result.append(msg)
+    result.append(sep.join(entries))
 
     return result
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls evenly so that at most `calls` happen every `period` seconds. Thread safe.
+    """
+
+    def __init__(self, calls: int, period: float = 1):
+        """
+        :param calls: Number of calls allowed in a period.
+        :param period: The period in seconds. Defaults to 1.
+        """
+        self._interval = period / calls
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """
+        Block until the caller is allowed to go on.
+        """
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self._interval
+        if delay > 0:
+            time.sleep(delay)